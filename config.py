@@ -11,6 +11,11 @@ class Config:
     E: int = 20
     # Whether or not to keep track of unsat core while solving
     unsat_core: bool = False
+    # Whether to turn off z3's auto-configuration, relevancy filtering and
+    # arithmetic equality propagation. Tends to help for large E
+    tune_smt: bool = False
+    # Whether to encode event types as bitvectors rather than integers
+    bv_event_type: bool = False
 
     def __init__(self):
         pass
@@ -1,10 +1,19 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+import copy
 import csv
-from pyz3_utils import IfStmt, Max, Min, MySolver, Variables, run_query
-from typing import List, Optional, Tuple
+from fractions import Fraction
+import io
+import os
+from pyz3_utils import MySolver, Variables
+import sys
+import threading
+from typing import Any, Dict, FrozenSet, List, Optional, Set, TextIO, \
+    Tuple
 import z3
 z3.set_option("parallel.threads.max", 4)
 z3.set_option("parallel.enable", "true")
-from z3 import And, If, Implies, Not, Or
+from z3 import And, ArithRef, BoolRef, If, Implies, Not, Or
 
 '''Each node starts doing backprop. At some arbitrary point in between, and
 certainly by the end of backprop, it will have the ability to send its (1/n)^th
@@ -24,6 +33,12 @@ class Config(Variables):
     num_nodes_per_ring: int = 3
     neighbors: List[Tuple[Tuple[int, int], Tuple[int, int]]] = \
         [((0, 0), (1, 0)), ((1, 1), (2, 1))]
+    # Assert (redundant) monotonicity lemmas to guide the solver. Turn off
+    # when the lemmas themselves are what is being verified
+    monotone_hints: bool = True
+    # Whether to turn off z3's auto-configuration, relevancy filtering and
+    # arithmetic equality propagation in `verify_sudarsanan_is_genius`
+    tune_smt: bool = False
 
 class Node(Variables):
     # r and n of my the node with which we share the uplink bottleneck
@@ -69,6 +84,29 @@ class GlobalVars(Variables):
         self.times = [Timestep(c, s, f"time{t}") for t in range(c.num_timesteps)]
 
 
+def min_term(*args) -> ArithRef:
+    ''' Like `Min`, but builds an If-term instead of allocating a variable
+    and its defining constraints. Use when the result is referenced once '''
+    res = args[0]
+    for x in args[1:]:
+        res = If(x < res, x, res)
+    return res
+
+
+def max_term(*args) -> ArithRef:
+    ''' Like `Max`, see `min_term` '''
+    res = args[0]
+    for x in args[1:]:
+        res = If(x > res, x, res)
+    return res
+
+
+def full_or_idle(ready: ArithRef, delta_t: ArithRef) -> BoolRef:
+    ''' Either there is enough data ready to keep the link busy for all of
+    `delta_t`, or there is none at all '''
+    return Or(ready >= delta_t, ready == 0)
+
+
 def tick(t2_id: int, c: Config, s: MySolver,
          v: GlobalVars):
     ''' Constrain how things evolve in time '''
@@ -76,86 +114,126 @@ def tick(t2_id: int, c: Config, s: MySolver,
     t1, t2 = v.times[t2_id-1], v.times[t2_id]
     delta_t = t2.time - t1.time
     s.add(delta_t >= 0)
+
+    # Constraints are collected per category and asserted as one conjunction
+    # each at the end, rather than one `add` per constraint
+    backprop_cs: List[BoolRef] = []
+    cap_cs: List[BoolRef] = []
+    send_cs: List[BoolRef] = []
+    fair_cs: List[BoolRef] = []
+    hint_cs: List[BoolRef] = []
     for r in range(c.num_rings):
         for n in range(c.num_nodes_per_ring):
             nt1 = t1.rings[r].nodes[n]
             nt2 = t2.rings[r].nodes[n]
+            # Terms used many times below. Built once so every use shares them
+            size = v.tot_size[r]
+            share = size / c.num_nodes_per_ring
+            prev_node = t1.rings[r].nodes[n-1]
 
             # Are we done with this round?
             new_round = And(nt1.backprop == v.tot_backprop[r],
-                            nt1.sum_sent == v.tot_size[r],
-                            nt1.broad_sent == v.tot_size[r])
-
-            IfStmt(new_round,
-                   # Increment round
-                   nt2.round == nt1.round + 1,
-                   # Do backprop
-                   nt2.backprop == Min(s, delta_t, v.tot_backprop[r]),
-                   # No time has elapsed
-                   t2.time == t1.time,
-            ).Else(
-                # Same old, same old
-                nt2.round == nt1.round,
-                # Do backprop
-                nt2.backprop ==
-                  Min(s, nt1.backprop + delta_t,
-                      v.tot_backprop[r])).add_to_solver(s)
+                            nt1.sum_sent == size,
+                            nt1.broad_sent == size)
+
+            # The If-then-else blocks below are written as pairs of
+            # implications over mutually exclusive cases, which z3's
+            # arithmetic preprocessing handles better than If
+            backprop_cs.append(Implies(
+                new_round,
+                And(
+                    # Increment round
+                    nt2.round == nt1.round + 1,
+                    # Do backprop
+                    nt2.backprop == min_term(delta_t, v.tot_backprop[r]),
+                    # No time has elapsed
+                    t2.time == t1.time)))
+            backprop_cs.append(Implies(
+                Not(new_round),
+                And(
+                    # Same old, same old
+                    nt2.round == nt1.round,
+                    # Do backprop
+                    nt2.backprop ==
+                      min_term(nt1.backprop + delta_t,
+                               v.tot_backprop[r]))))
 
             # How much do we send for summing?
             ## Cap due to backprop, we'll let z3 pick if backprop is not done
             sum_backprop_cap = s.Real(f"backprop_cap{t2_id},{r},{n}")
             ### No caps if backprop is done
-            s.add(Implies(nt2.backprop >= v.tot_backprop[r],
-                  sum_backprop_cap == v.tot_size[r]))
-            s.add(sum_backprop_cap >= 0)
+            cap_cs.append(Implies(nt2.backprop >= v.tot_backprop[r],
+                                  sum_backprop_cap == size))
+            cap_cs.append(sum_backprop_cap >= 0)
 
             ## Cap because of whether or not we received from the previous node
-            node_round_diff = t1.rings[r].nodes[n-1].round - nt1.round
-            sum_recv_cap = v.tot_size[r] / c.num_nodes_per_ring\
-                + If(node_round_diff > 0, v.tot_size[r],
-                     If(node_round_diff < 0, 0,
-                        t1.rings[r].nodes[n-1].sum_sent))
-            broad_recv_cap = v.tot_size[r] / c.num_nodes_per_ring\
-                + If(node_round_diff > 0, v.tot_size[r],
-                     If(node_round_diff < 0, 0,
-                        t1.rings[r].nodes[n-1].broad_sent))
+            node_round_diff = prev_node.round - nt1.round
+            ### Sign of node_round_diff, classified once and shared by both caps
+            rd_sign = s.Int(f"round_diff_sign{t2_id},{r},{n}")
+            sum_recv_cap = s.Real(f"sum_recv_cap{t2_id},{r},{n}")
+            broad_recv_cap = s.Real(f"broad_recv_cap{t2_id},{r},{n}")
+            cap_cs.extend([
+                Implies(node_round_diff > 0, rd_sign == 1),
+                Implies(node_round_diff < 0, rd_sign == -1),
+                Implies(node_round_diff == 0, rd_sign == 0),
+                Implies(rd_sign == 1, sum_recv_cap == share + size),
+                Implies(rd_sign == -1, sum_recv_cap == share),
+                Implies(rd_sign == 0,
+                        sum_recv_cap == share + prev_node.sum_sent),
+                Implies(rd_sign == 1, broad_recv_cap == share + size),
+                Implies(rd_sign == -1, broad_recv_cap == share),
+                Implies(rd_sign == 0,
+                        broad_recv_cap == share + prev_node.broad_sent)])
 
             # Update ready_to_send, sum_sent and broad_sent
-            IfStmt(new_round,
-                   # No summing or broadcast has started. If z3 wants to sum,
-                   # it can always use one extra timestamp
-                   nt2.sum_sent == 0,
-                   nt2.broad_sent == 0,
-                   nt2.ready_to_send == 0,
-            ).Elif(
-                t1.rings[r].nodes[n].sum_sent < v.tot_size[r],
-                # ^ We are still summing
-                nt2.ready_to_send ==
-                Max(s, 0,
-                    Min(s, sum_recv_cap, sum_backprop_cap, v.tot_size[r])
-                    - nt1.sum_sent),
-                nt2.sum_sent == nt1.sum_sent + nt2.tot_data_sent,
-                nt2.broad_sent == nt1.broad_sent
-            ).Else(
-                # We are broadcasting
-                nt2.ready_to_send ==
-                Max(s, 0,
-                    Min(s, broad_recv_cap, v.tot_size[r])
-                    - nt1.broad_sent),
-                nt2.broad_sent == nt1.broad_sent + nt2.tot_data_sent,
-                nt2.sum_sent == nt1.sum_sent
-            ).add_to_solver(s)
+            summing = And(Not(new_round), nt1.sum_sent < size)
+            broadcasting = And(Not(new_round), nt1.sum_sent >= size)
+            send_cs.append(Implies(
+                new_round,
+                # No summing or broadcast has started. If z3 wants to sum,
+                # it can always use one extra timestamp
+                And(nt2.sum_sent == 0,
+                    nt2.broad_sent == 0,
+                    nt2.ready_to_send == 0)))
+            send_cs.append(Implies(
+                summing,
+                And(nt2.ready_to_send ==
+                    max_term(0,
+                             min_term(sum_recv_cap, sum_backprop_cap, size)
+                             - nt1.sum_sent),
+                    nt2.sum_sent == nt1.sum_sent + nt2.tot_data_sent,
+                    nt2.broad_sent == nt1.broad_sent)))
+            send_cs.append(Implies(
+                broadcasting,
+                And(nt2.ready_to_send ==
+                    max_term(0,
+                             min_term(broad_recv_cap, size)
+                             - nt1.broad_sent),
+                    nt2.broad_sent == nt1.broad_sent + nt2.tot_data_sent,
+                    nt2.sum_sent == nt1.sum_sent)))
+            # The three cases are exhaustive
+            send_cs.append(Or(new_round, summing, broadcasting))
+
+            if c.monotone_hints:
+                # Follows from the above, but spares z3 re-deriving it
+                # through the case splits
+                hint_cs.append(nt2.round >= nt1.round)
+                hint_cs.append(Implies(
+                    Not(new_round),
+                    And(nt2.backprop >= nt1.backprop,
+                        nt2.sum_sent >= nt1.sum_sent,
+                        nt2.broad_sent >= nt1.broad_sent)))
 
             # Decide tot_data_sent based on ready_to_send
             assert nt1 != nt2
             if nt2.neighbor is None:
-                s.add(nt2.tot_data_sent == Min(s, nt2.ready_to_send, delta_t))
+                fair_cs.append(
+                    nt2.tot_data_sent == min_term(nt2.ready_to_send, delta_t))
                 # This ensures that the timesteps are such that link
                 # utilization is 100% or 0%. Sure we could simplify above due
                 # to this constraint, but meh. Let's keep the flexibility to
                 # enable/disable this for now
-                s.add(Or(nt2.ready_to_send >= delta_t,
-                         nt2.ready_to_send == 0))
+                fair_cs.append(full_or_idle(nt2.ready_to_send, delta_t))
             else:
                 # Only one of the neighbors needs to do this
                 assert r != nt2.neighbor[0]
@@ -171,34 +249,35 @@ def tick(t2_id: int, c: Config, s: MySolver,
                     # Neither should dominate the other
                     eq_cond = nt1.sum_sent + nt1.broad_sent\
                         == oth1.sum_sent + oth1.broad_sent
-                    IfStmt(
+                    fair_cs.append(Implies(
                         nt2.ready_to_send + oth2.ready_to_send < delta_t,
-                        nt2.tot_data_sent == nt2.ready_to_send,
-                        oth2.tot_data_sent == oth2.ready_to_send
-                    ).Else(
-                        nt2.tot_data_sent + oth2.tot_data_sent == delta_t,
-                        nt2.tot_data_sent <= nt2.ready_to_send,
-                        oth2.tot_data_sent <= oth2.ready_to_send,
-                        Implies(dom_cond,
-                                nt2.tot_data_sent > oth2.tot_data_sent),
-                        Implies(undom_cond,
-                                nt2.tot_data_sent < oth2.tot_data_sent),
-                        Implies(eq_cond,
-                                nt2.tot_data_sent == oth2.tot_data_sent)
-                    ).add_to_solver(s)
+                        And(nt2.tot_data_sent == nt2.ready_to_send,
+                            oth2.tot_data_sent == oth2.ready_to_send)))
+                    fair_cs.append(Implies(
+                        nt2.ready_to_send + oth2.ready_to_send >= delta_t,
+                        And(nt2.tot_data_sent + oth2.tot_data_sent == delta_t,
+                            nt2.tot_data_sent <= nt2.ready_to_send,
+                            oth2.tot_data_sent <= oth2.ready_to_send,
+                            Implies(dom_cond,
+                                    nt2.tot_data_sent > oth2.tot_data_sent),
+                            Implies(undom_cond,
+                                    nt2.tot_data_sent < oth2.tot_data_sent),
+                            Implies(eq_cond,
+                                    nt2.tot_data_sent == oth2.tot_data_sent))))
 
                     # This ensures that the timesteps are such that link
                     # utilization is 100% or 0%
-                    s.add(Or(
-                        oth2.ready_to_send + nt2.ready_to_send >= delta_t,
-                        oth2.ready_to_send + nt2.ready_to_send == 0))
+                    fair_cs.append(full_or_idle(
+                        oth2.ready_to_send + nt2.ready_to_send, delta_t))
                     # We can additionally enforce that each sender can
                     # individually fill up the time. Z3 will be forced to pick
                     # smaller time gaps if needed
-                    s.add(Or(nt2.ready_to_send >= delta_t,
-                             nt2.ready_to_send == 0))
-                    s.add(Or(oth2.ready_to_send >= delta_t,
-                             oth2.ready_to_send == 0))
+                    fair_cs.append(full_or_idle(nt2.ready_to_send, delta_t))
+                    fair_cs.append(full_or_idle(oth2.ready_to_send, delta_t))
+
+    for cs in [backprop_cs, cap_cs, send_cs, fair_cs, hint_cs]:
+        if len(cs) > 0:
+            s.add(And(*cs))
 
 
 def make_solver(c: Config, s: MySolver) -> GlobalVars:
@@ -222,18 +301,21 @@ def make_solver(c: Config, s: MySolver) -> GlobalVars:
         s.add(v.times[t].rings[r].nodes[0].round == 0)
 
     for r in range(c.num_rings):
+        # One term per ring-wide quantity, shared by every constraint below
+        tot_size, tot_backprop = v.tot_size[r], v.tot_backprop[r]
+        share = tot_size / c.num_nodes_per_ring
         for nid in range(c.num_nodes_per_ring):
             n = v.times[0].rings[r].nodes[nid]
             # Broadcast can only start when sum and backprop is finished
             s.add(Implies(n.broad_sent > 0,
-                          And(n.sum_sent == v.tot_size[r],
-                              n.backprop == v.tot_backprop[r])))
+                          And(n.sum_sent == tot_size,
+                              n.backprop == tot_backprop)))
 
             # We should not have sent more than we had received
             s.add(n.sum_sent <= v.times[0].rings[r].nodes[nid-1].sum_sent
-                  + v.tot_size[r] / c.num_nodes_per_ring)
+                  + share)
             s.add(n.broad_sent <= v.times[0].rings[r].nodes[nid-1].broad_sent
-                  + v.tot_size[r] / c.num_nodes_per_ring)
+                  + share)
 
             # If the rounds are different:
             for nid2 in range(c.num_nodes_per_ring):
@@ -244,41 +326,186 @@ def make_solver(c: Config, s: MySolver) -> GlobalVars:
                     # a time and assert that we cannot progress farther than
                     # doing our own backprop and sending our sum
                     Or(And(n2.round == n.round + 1,
-                           n2.sum_sent <= v.tot_size[r] / c.num_nodes_per_ring),
+                           n2.sum_sent <= share),
                        And(n2.round == n.round - 1,
-                           n.sum_sent <= v.tot_size[r] / c.num_nodes_per_ring),
+                           n.sum_sent <= share),
                 )))
 
     # Basic conditions that hold at all times
     for r in range(c.num_rings):
-        s.add(v.tot_size[r] > 0)
-        s.add(v.tot_backprop[r] > 0)
+        tot_size, tot_backprop = v.tot_size[r], v.tot_backprop[r]
+        s.add(tot_size > 0)
+        s.add(tot_backprop > 0)
         for t in range(c.num_timesteps):
             for n in v.times[t].rings[r].nodes:
                 s.add(n.backprop >= 0)
-                s.add(n.backprop <= v.tot_backprop[r])
+                s.add(n.backprop <= tot_backprop)
                 s.add(n.sum_sent >= 0)
                 s.add(n.broad_sent >= 0)
-                s.add(n.sum_sent <= v.tot_size[r])
-                s.add(n.broad_sent <= v.tot_size[r])
+                s.add(n.sum_sent <= tot_size)
+                s.add(n.broad_sent <= tot_size)
                 s.add(n.tot_data_sent >= 0)
     return v
 
 
-def plot(c: Config, v: Variables):
-    print("Format: round,backprop,sum_sent,broad_sent")
+def symmetric_rings(c: Config) -> List[List[int]]:
+    ''' Partition the rings into classes whose rings can be permuted
+    arbitrarily without changing `c.neighbors` (node ids within a ring stay as
+    they are) '''
+    def links(neighbors) -> Set[FrozenSet[Tuple[int, int]]]:
+        return {frozenset(pair) for pair in neighbors}
+
+    orig = links(c.neighbors)
+    classes = [[r] for r in range(c.num_rings)]
+    for r1 in range(c.num_rings):
+        for r2 in range(r1 + 1, c.num_rings):
+            swap = {r1: r2, r2: r1}
+            swapped = links([((swap.get(ra, ra), na), (swap.get(rb, rb), nb))
+                             for ((ra, na), (rb, nb)) in c.neighbors])
+            if swapped != orig:
+                continue
+            # Transpositions generate all permutations of the merged class
+            cls1 = next(x for x in classes if r1 in x)
+            cls2 = next(x for x in classes if r2 in x)
+            if cls1 is not cls2:
+                classes.remove(cls2)
+                cls1.extend(cls2)
+    return [sorted(x) for x in classes]
+
+
+def break_ring_symmetry(c: Config, s: MySolver, v: GlobalVars):
+    ''' Order interchangeable rings by model size. Only sound for queries that
+    are themselves invariant under those ring permutations '''
+    for cls in symmetric_rings(c):
+        for r1, r2 in zip(cls, cls[1:]):
+            s.add(v.tot_size[r1] <= v.tot_size[r2])
+
+
+# Equivalence-preserving preprocessing. Tactics that eliminate variables
+# (solve-eqs, elim-uncnstr) are deliberately left out: constraints added after
+# presimplification and the model read by `run_query` still refer to them
+PRESIMPLIFY = z3.Then("simplify", "propagate-values", "ctx-simplify")
+
+
+def presimplify(s: MySolver):
+    ''' Replace the constraints in `s` by a simplified, equivalent set. Meant
+    to be run once on the large base formula before the (small) query is added
+    '''
+    if s.track_unsat:
+        # Simplification would merge the tracked constraints
+        return
+    g = z3.Goal()
+    g.add(*s.assertions())
+    res = PRESIMPLIFY(g)
+    assert len(res) == 1
+    s.s.reset()
+    s.s.add(res[0].as_expr())
+
+
+def clone_solver(s: MySolver, ctx: Optional[z3.Context] = None) -> z3.Solver:
+    ''' A copy of the z3 solver underneath `s` in context `ctx` (a new one by
+    default). Unlike building a fresh solver and re-adding `s.assertions()`,
+    this carries over the solver's state. Clones in different contexts can be
+    checked concurrently from different threads '''
+    if ctx is None:
+        ctx = z3.Context()
+    return s.s.translate(ctx)
+
+
+def check_parallel(s: MySolver, assumptions: List[BoolRef], timeout: float,
+                   max_workers: int = 4)\
+        -> Tuple[List[z3.CheckSatResult], List[Optional[z3.ModelRef]]]:
+    ''' Check the constraints in `s` under each of `assumptions` separately,
+    in up to `max_workers` parallel threads, each on its own clone of `s`. As
+    soon as one of them is sat, the others are interrupted and reported as
+    unknown. `timeout` is in seconds. Returns the results and, for those that
+    are sat, the model (in the context of `s`) '''
+    # Translating reads the main context, so translate everything (solver and
+    # assumptions) before starting any thread. The threads then only touch
+    # their own context
+    ctxs = [z3.Context() for _ in assumptions]
+    clones = [clone_solver(s, ctx) for ctx in ctxs]
+    local = [a.translate(ctx) for (a, ctx) in zip(assumptions, ctxs)]
+    for clone in clones:
+        clone.set(timeout=int(timeout * 1000))
+    found_sat = threading.Event()
+
+    def check(i: int) -> z3.CheckSatResult:
+        if found_sat.is_set():
+            return z3.unknown
+        return clones[i].check(local[i])
+
+    results = [z3.unknown] * len(assumptions)
+    models: List[Optional[z3.ModelRef]] = [None] * len(assumptions)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(check, i): i
+                   for i in range(len(assumptions))}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if results[i] == z3.sat:
+                # This thread is the only one using the main context, and the
+                # clone is done
+                models[i] = clones[i].model().translate(s.s.ctx)
+            if results[i] == z3.sat and not found_sat.is_set():
+                found_sat.set()
+                for j, ctx in enumerate(ctxs):
+                    if j != i:
+                        ctx.interrupt()
+    return (results, models)
+
+
+def model_values(x: Any, m: z3.ModelRef) -> Any:
+    ''' A copy of `x`, which may be a `Variables`, a list or a z3 term, with
+    every z3 term replaced by its value in `m`. This is the form of the
+    variables that `run_query` returns '''
+    if isinstance(x, z3.ExprRef):
+        val = m.eval(x, model_completion=True)
+        if z3.is_bool(val):
+            return z3.is_true(val)
+        if z3.is_algebraic_value(val):
+            val = val.approx(20)
+        # Rationals print as "p/q"
+        return Fraction(str(val))
+    if isinstance(x, list):
+        return [model_values(y, m) for y in x]
+    if isinstance(x, Variables):
+        res = copy.copy(x)
+        res.__dict__ = {k: model_values(y, m) for (k, y) in x.__dict__.items()}
+        return res
+    return x
+
+
+def plot(c: Config, v: Variables, out: Optional[TextIO] = None,
+         writer: Optional[Any] = None):
+    ''' Print the trace in `v` to `out` (stdout if not given) and write it as
+    CSV rows to `writer` (a fresh output.csv if not given) '''
+    if out is None:
+        # Looked up now rather than at import, so redirection still applies
+        out = sys.stdout
+    print("Format: round,backprop,sum_sent,broad_sent", file=out)
     print(f"tot_backprop: {[float(x) for x in v.tot_backprop]}, "
-          f"tot_size: {[float(x) for x in v.tot_size]}")
+          f"tot_size: {[float(x) for x in v.tot_size]}", file=out)
     def pprint(n: Node, name: str) -> float:
         if name in n.__dict__:
             return float(n.__dict__[name])
         return -1.0
-    writer = csv.writer(open("output.csv", "w"))
+    if writer is None:
+        writer = csv.writer(open("output.csv", "w"))
 
     for t in range(c.num_timesteps):
-        line = f"{float(v.times[t].time):4.2} "
-        row = [float(v.times[t].time)]
+        time = float(v.times[t].time)
+        line = f"{time:4.2} "
+        row: List[Any] = [time]
         for r in range(c.num_rings):
+            # Convert every value once. Both the printout and the CSV use them
+            vals = [(int(n.round),
+                     float(n.backprop),
+                     float(n.sum_sent),
+                     float(n.broad_sent),
+                     pprint(n, "tot_data_sent"),
+                     pprint(n, "ready_to_send"))
+                    for n in v.times[t].rings[r].nodes]
             # line += '\t: '.join(
             #     ["{:.2},{:.2},{:.2}".format(
             #         float(n.backprop),
@@ -288,32 +515,32 @@ def plot(c: Config, v: Variables):
             #         # pprint(n, "ready_to_send"))
             #      for n in v.times[t].rings[r].nodes])
             line += ' : '.join(
-                [f"{int(n.round)},"
-                 f"{float(n.backprop):4.2},"
-                 f"{float(n.sum_sent):4.2},"
-                 f"{float(n.broad_sent):4.2},"
-                 f"{pprint(n, 'tot_data_sent'):4.2},"
-                 f"{pprint(n, 'ready_to_send'):4.2}"
-                 for n in v.times[t].rings[r].nodes])
+                [f"{rnd},{backprop:4.2},{sum_sent:4.2},{broad_sent:4.2},"
+                 f"{tot_data_sent:4.2},{ready_to_send:4.2}"
+                 for (rnd, backprop, sum_sent, broad_sent, tot_data_sent,
+                      ready_to_send) in vals])
 
-            for n in v.times[t].rings[r].nodes:
-                row.extend([
-                    int(n.round),
-                    float(n.backprop),
-                    float(n.sum_sent),
-                    float(n.broad_sent),
-                    pprint(n, "tot_data_sent"),
-                    pprint(n, "ready_to_send"),
-                    "---"])
+            for val in vals:
+                row.extend([*val, "---"])
             row[-1] += ":---"
-        print(line)
+        print(line, file=out)
 
         writer.writerow(row)
 
 
-def verify_sudarsanan_is_genius(c: Config):
+def verify_sudarsanan_is_genius(c: Config, writer: Any,
+                                threads: int = 4) -> str:
+    ''' Returns the result (and counterexample, if any) as printable text. The
+    counterexample's CSV rows go to `writer`. Uses up to `threads` solver
+    threads '''
     s = MySolver()
+    if c.tune_smt:
+        # Only this solver, so that others in the process are unaffected
+        s.s.set("smt.auto_config", False)
+        s.s.set("smt.relevancy", 0)
+        s.s.set("smt.arith.propagate_eqs", False)
     v = make_solver(c, s)
+    presimplify(s)
 
     if False:
         # Just so the example has nice values
@@ -321,6 +548,14 @@ def verify_sudarsanan_is_genius(c: Config):
             s.add(v.tot_size[r] <= 5)
             s.add(v.tot_backprop[r] <= 5)
 
+    # Keep the question in its own scope so `s` can be reused for other
+    # questions on the same base afterwards
+    s.push()
+
+    # The question below treats all neighbor pairs alike, so it is symmetric
+    # under the same ring permutations as the model
+    break_ring_symmetry(c, s, v)
+
     # Let's ask the big question
     cond = []
     for ((r1, n1), (r2, n2)) in c.neighbors:
@@ -345,62 +580,110 @@ def verify_sudarsanan_is_genius(c: Config):
         s.add(2 * v.tot_size[r1] > v.tot_backprop[r2])
         s.add(2 * v.tot_size[r2] > v.tot_backprop[r1])
 
-    s.add(Or(*cond))
-
-    res = run_query(c, s, v, timeout=3600)
-    print(res.satisfiable)
+    # Rather than asserting Or(*cond), guard each disjunct by an assumption
+    # literal and ask about them separately, in parallel
+    trackers = []
+    for i, q in enumerate(cond):
+        p = s.Bool(f"overlap_cond{i}")
+        s.add(Implies(p, q))
+        trackers.append(p)
+
+    results, models = check_parallel(s, trackers, timeout=3600,
+                                     max_workers=threads)
+    if z3.sat in results:
+        satisfiable = "sat"
+    elif z3.unknown in results:
+        satisfiable = "unknown"
+    else:
+        satisfiable = "unsat"
+    out = io.StringIO()
+    print(satisfiable, file=out)
+
+    if satisfiable == "sat":
+        # Plot the counterexample for the first disjunct that was satisfiable
+        plot(c, model_values(v, models[results.index(z3.sat)]), out, writer)
+    s.pop()
+    return out.getvalue()
+
+
+# The configurations verified when this file is run
+SWEEP_CONFIGS: List[Dict[str, Any]] = [
+    {
+        "num_rings": 2,
+        "num_nodes_per_ring": 3,
+        "neighbors": [((0, 0), (1, 0))],
+        "num_timesteps": 5,
+    },
+    {
+        "num_rings": 2,
+        "num_nodes_per_ring": 4,
+        "neighbors": [((0, 0), (1, 0))],
+        "num_timesteps": 5,
+    },
+    {
+        "num_rings": 2,
+        "num_nodes_per_ring": 4,
+        "neighbors": [((0, 0), (1, 0)), ((0, 2), (1, 2))],
+        "num_timesteps": 5,
+    },
+    {
+        "num_rings": 3,
+        "num_nodes_per_ring": 3,
+        "neighbors": [((0, 0), (1, 0)), ((1, 1), (2, 1)), ((2, 2), (0, 2))],
+        "num_timesteps": 10,
+    },
+    {
+        "num_rings": 3,
+        "num_nodes_per_ring": 3,
+        "neighbors": [((0, 0), (1, 0)), ((1, 1), (2, 1))],
+        "num_timesteps": 10,
+    },
+    {
+        "num_rings": 4,
+        "num_nodes_per_ring": 3,
+        "neighbors": [((0, 0), (1, 0)), ((1, 1), (2, 1)), ((2, 2), (3, 2))],
+        "num_timesteps": 10,
+    }
+]
+
+
+def config_from_dict(conf: Dict[str, Any]) -> Config:
+    ''' The `Config` described by one of `SWEEP_CONFIGS` '''
+    c = Config()
+    c.num_rings = conf["num_rings"]
+    c.num_nodes_per_ring = conf["num_nodes_per_ring"]
+    c.neighbors = conf["neighbors"]
+    c.num_timesteps = conf["num_timesteps"]
+    return c
+
+
+def verify_config(conf: Dict[str, Any]) -> Tuple[str, str]:
+    ''' Process-pool entry point for `verify_sudarsanan_is_genius`. Returns
+    the printable result and the counterexample's CSV rows (if any) '''
+    # Parallelism comes from running several configs at once. Don't
+    # oversubscribe the cores with more solver threads, z3's own or ours
+    z3.set_option("parallel.threads.max", 1)
+    c = config_from_dict(conf)
+    csv_out = io.StringIO()
+    out = verify_sudarsanan_is_genius(c, csv.writer(csv_out), threads=1)
+    return (out, csv_out.getvalue())
 
-    if res.satisfiable == "sat":
-        plot(res.c, res.v)
 
 if __name__ == "__main__":
-    configs = [
-        {
-            "num_rings": 2,
-            "num_nodes_per_ring": 3,
-            "neighbors": [((0, 0), (1, 0))],
-            "num_timesteps": 5,
-        },
-        {
-            "num_rings": 2,
-            "num_nodes_per_ring": 4,
-            "neighbors": [((0, 0), (1, 0))],
-            "num_timesteps": 5,
-        },
-        {
-            "num_rings": 2,
-            "num_nodes_per_ring": 4,
-            "neighbors": [((0, 0), (1, 0)), ((0, 2), (1, 2))],
-            "num_timesteps": 5,
-        },
-        {
-            "num_rings": 3,
-            "num_nodes_per_ring": 3,
-            "neighbors": [((0, 0), (1, 0)), ((1, 1), (2, 1)), ((2, 2), (0, 2))],
-            "num_timesteps": 10,
-        },
-        {
-            "num_rings": 3,
-            "num_nodes_per_ring": 3,
-            "neighbors": [((0, 0), (1, 0)), ((1, 1), (2, 1))],
-            "num_timesteps": 10,
-        },
-        {
-            "num_rings": 4,
-            "num_nodes_per_ring": 3,
-            "neighbors": [((0, 0), (1, 0)), ((1, 1), (2, 1)), ((2, 2), (3, 2))],
-            "num_timesteps": 10,
-        }
-    ]
-
-    for conf in configs:
-        print(conf)
-        c = Config()
-        c.num_rings = conf["num_rings"]
-        c.num_nodes_per_ring = conf["num_nodes_per_ring"]
-        c.neighbors = conf["neighbors"]
-        c.num_timesteps = conf["num_timesteps"]
-        verify_sudarsanan_is_genius(c)
+    configs = SWEEP_CONFIGS
+
+    # The configs are independent, so verify them in parallel processes
+    workers = min(len(configs), os.cpu_count() or 1)
+    # All counterexamples go to one CSV file, one section per config
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            open("output.csv", "w", buffering=1 << 20) as csv_file:
+        for conf, (out, rows) in zip(configs,
+                                     executor.map(verify_config, configs)):
+            print(conf)
+            print(out, end="")
+            if rows != "":
+                csv.writer(csv_file).writerow([conf])
+                csv_file.write(rows)
 
     # c.num_nodes_per_ring = 3
     # c.neighbors = [((0, 0), (1, 0)), ((1, 1), (2, 1)), ((2, 2), (0, 2))]
@@ -1,11 +1,16 @@
 from config import Config
 from my_solver import MySolver
+from simulate import Time, exact, simulate_phases
 from utils import ModelDict, model_to_dict
 from variables import Variables
 
+from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
-from typing import Tuple
-from z3 import And, If, Implies, Not, Or
+from multiprocessing import Pool
+import os
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import z3
+from z3 import And, BoolRef, If, Implies, Not, Or, RealVal, ULE
 
 '''# A node's local view
 
@@ -29,37 +34,52 @@ it can begin the training phase of the next iterations
 '''
 
 
-def phases(c: Config, o: MySolver, v: Variables):
-    ''' Constraints for when the various phases happen for each node '''
-    for n in range(c.N):
-        pre = (n - 1) % c.N
-        for s in range(c.S):
+def phases(c: Config, o: MySolver, v: Variables,
+           nodes: Optional[Iterable[int]] = None,
+           steps: Optional[Iterable[int]] = None):
+    ''' Constraints for when the various phases happen for each node. If
+    `nodes` or `steps` are given, only add the constraints for those nodes
+    and iterations '''
+    # Ring predecessor of each node
+    pre_of = [(n - 1) % c.N for n in range(c.N)]
+
+    for n in (range(c.N) if nodes is None else nodes):
+        # Collect this node's constraints and add them to the solver at once
+        cs = []
+        # Look up this node's and its predecessor's terms once rather than in
+        # the inner loops
+        pre = pre_of[n]
+        tr, su, br = v.tr[n], v.su[n], v.br[n]
+        su_end_n, br_end_n = v.su_end[n], v.br_end[n]
+        br_pre = v.br[pre]
+        su_end_pre, br_end_pre = v.su_end[pre], v.br_end[pre]
+        for s in (range(c.S) if steps is None else steps):
             if s == 0:
-                o.add(v.tr[n][s] == 0)
+                cs.append(tr[s] == 0)
             else:
                 # Note, the last broadcast is a pseudo-event
-                o.add(v.tr[n][s] == v.br[pre][s-1][-1])
+                cs.append(tr[s] == br_pre[s-1][-1])
 
             # First sum transmit starts after training is done
-            o.add(v.su[n][s][0] == v.tr[n][s] + v.C_tr)
+            cs.append(su[s][0] == tr[s] + v.C_tr)
 
             # First broadcast happens when the last sum transmit starts because
             # the last sum transmit is not really needed. It is a pseudo-event
-            o.add(v.br[n][s][0] == v.su[n][s][-1])
+            cs.append(br[s][0] == su[s][-1])
 
             for i in range(1, c.N):
                 # Summing phase:
                 # The next block is ready to be sent
-                ready = v.su[pre][s][i-1] + v.su_tx[pre][s][i-1] + v.C_su
+                ready = su_end_pre[s][i-1] + v.C_su
                 # Tx link is clear for sending
-                clear = v.su[n][s][i-1] + v.su_tx[n][s][i-1]
+                clear = su_end_n[s][i-1]
                 # When are we sending the next block
-                o.add(v.su[n][s][i] == If(ready > clear, ready, clear))
+                cs.append(su[s][i] == If(ready > clear, ready, clear))
 
                 # Broadcast phase: analogous to summing phase
-                ready = v.br[pre][s][i-1] + v.br_tx[pre][s][i-1]
-                clear = v.br[n][s][i-1] + v.br_tx[n][s][i-1]
-                o.add(v.br[n][s][i] == If(ready > clear, ready, clear))
+                ready = br_end_pre[s][i-1]
+                clear = br_end_n[s][i-1]
+                cs.append(br[s][i] == If(ready > clear, ready, clear))
 
             # # For now, all except one transmit times are equal
             # for i in range(c.N):
@@ -70,105 +90,146 @@ def phases(c: Config, o: MySolver, v: Variables):
             #         o.add(v.su_tx[n][s][i] == 1)
             #         o.add(v.br_tx[n][s][i] == 1)
 
+        o.add(*cs)
+
+
+def our_flows(c: Config, v: Variables, n: int, steps: Iterable[int])\
+        -> List[BoolRef]:
+    ''' Each of our transmissions on link `n` is a flow that starts and ends.
+    Returns constraints that make sure each of these events in the given
+    iterations is represented in v.events, and that `v.outstanding` and
+    `v.event_type` are correct at the event where our flow starts/ends '''
+    cs = []
+    # The slot of an event cannot be fixed up front since other flows' events
+    # interleave with ours. But since events are strictly increasing, at most
+    # one slot can match, so a single disjunction over the slots suffices
+    for s in steps:
+        for i in range(c.N):
+            for (start, end) in [(v.su[n][s][i], v.su_end[n][s][i]),
+                                 (v.br[n][s][i], v.br_end[n][s][i])]:
+                cs.append(Or(*[And(event == start,
+                                   v.outstanding[n][0][e] == v.B,
+                                   v.event_type[n][e] == 0)
+                               for (e, event) in enumerate(v.events[n])]))
+                cs.append(Or(*[And(event == end,
+                                   v.outstanding[n][0][e] == 0.0,
+                                   v.event_type[n][e] == 1)
+                               for (e, event) in enumerate(v.events[n])]))
+    return cs
+
+
+def tx_times(c: Config, o: MySolver, v: Variables,
+             nodes: Optional[Iterable[int]] = None):
+    ''' Figure out transmit times based on fair sharing policy. If `nodes` is
+    given, only add the constraints for those nodes '''
+    # Event types for the start/end of each flow, and the rate each flow gets
+    # when f flows share the link. These are the same for every link
+    start_type = [2 * f for f in range(c.F)]
+    end_type = [2 * f + 1 for f in range(c.F)]
+    rate = [RealVal(0)] + [RealVal(c.C) / f for f in range(1, c.F + 1)]
+
+    for n in (range(c.N) if nodes is None else nodes):
+        # Collect this node's constraints and add them to the solver at once
+        cs = []
+        events, et = v.events[n], v.event_type[n]
+        nf, out = v.num_flows[n], v.outstanding[n]
 
-def tx_times(c: Config, o: MySolver, v: Variables):
-    ''' Figure out transmit times based on fair sharing policy '''
-    for n in range(c.N):
         # First, events are monotonic. For simplicity, two events cannot happen
         # at the same time. They *can* happen arbitrarily close to each other
         # though
         for s in range(1, c.E):
-            o.add(v.events[n][s-1] < v.events[n][s])
+            cs.append(events[s-1] < events[s])
 
         # Event type, num flows and outstanding must be within range
         for e in range(c.E):
-            o.add(v.event_type[n][e] <= 2 * c.F)
-            o.add(0 <= v.event_type[n][e])
+            if c.bv_event_type:
+                # Unsigned, so it cannot be negative
+                cs.append(ULE(et[e], 2 * c.F))
+            else:
+                cs.append(et[e] <= 2 * c.F)
+                cs.append(0 <= et[e])
 
-            o.add(v.num_flows[n][e] <= c.F)
-            o.add(0 <= v.num_flows[n][e])
+            cs.append(nf[e] <= c.F)
+            cs.append(0 <= nf[e])
 
             for f in range(c.F):
-                o.add(0 <= v.outstanding[n][f][e])
+                cs.append(0 <= out[f][e])
 
         # Some initial conditions
         for f in range(c.F):
-            o.add(v.outstanding[n][f][0] == 0)
+            cs.append(out[f][0] == 0)
 
-        # This is the list of flow events that occured on this link. We have
-        # this for convenience. Each event is a time instant where a flow
-        # started or ended
-        our_starts = []
-        our_ends = []
-        for s in range(c.S):
-            our_starts.extend(v.su[n][s])
-            our_starts.extend(v.br[n][s])
-            for i in range(c.N):
-                our_ends.append(v.su[n][s][i] + v.su_tx[n][s][i])
-                our_ends.append(v.br[n][s][i] + v.br_tx[n][s][i])
-
-        for (start, end) in zip(our_starts, our_ends):
-            # Make sure each of our_events are represented in v.events
-            o.add(Or(*[start == event for event in v.events[n]]))
-            o.add(Or(*[end == event for event in v.events[n]]))
-
-            # Further, ensure that `v.outstanding` and `v.event_type` are
-            # correct when our event starts/ends
-            for (e, event) in enumerate(v.events[n]):
-                o.add(Implies(
-                    event == start,
-                    And(v.outstanding[n][0][e] == v.B,
-                        v.event_type[n][e] == 0)))
-
-                o.add(Implies(
-                    event == end,
-                    And(v.outstanding[n][0][e] == 0.0,
-                        v.event_type[n][e] == 1)))
+        cs.extend(our_flows(c, v, n, range(c.S)))
+
+        # Whether event e is the start/end of flow f. These are used by
+        # several constraints below, so build them once
+        is_start = [[et[e] == t for t in start_type] for e in range(c.E)]
+        is_end = [[et[e] == t for t in end_type] for e in range(c.E)]
 
         # Start and stop conditions for other flows
         for f in range(c.F):
             # Ensure a flow starts only after the previous sub-flow ended
             for e in range(1, c.E):
-                o.add(Implies(v.event_type[n][e] == 2 * f,
-                              v.outstanding[n][f][e-1] == 0))
+                cs.append(Implies(is_start[e][f], out[f][e-1] == 0))
             # Flow only ends when it has transmitted all bytes
             for e in range(1, c.E):
-                o.add(Implies(v.event_type[n][e] == 2 * f + 1,
-                              v.outstanding[n][f][e] == 0))
+                cs.append(Implies(is_end[e][f], out[f][e] == 0))
 
         # Continuation equation for `v.outstanding`
         for e in range(1, c.E):
             # First compute how much each flow should decrease its
-            # outstanding. Need to do it in a loop to avoid multiplications
-            # with `v.num_flows`
-            decrease = o.Real(f"outstanding_decrease_{n},{e}")
-            for f in range(1, c.F + 1):
-                o.add(Implies(v.num_flows[n][e] == f, decrease == c.C / f))
-            o.add(Implies(v.num_flows[n][e] == 0, decrease == 0))
+            # outstanding. Select it with a chain of Ifs to avoid
+            # multiplications with `v.num_flows`
+            decrease = rate[0]
+            for f in range(c.F, 0, -1):
+                decrease = If(nf[e] == f, rate[f], decrease)
 
             # If the event does not correspond to this flow, it transmits bytes
             # depending on number of flows and transmission policy
             for f in range(c.F):
-                new = v.outstanding[n][f][e] - decrease
-                o.add(Implies(
-                    And(v.event_type[n][e] != 2 * f,
-                        v.event_type[n][e] != 2 * f + 1),
-                    v.outstanding[n][f][e] == If(new >= 0, new, 0)))
+                new = out[f][e] - decrease
+                cs.append(Implies(
+                    And(Not(is_start[e][f]), Not(is_end[e][f])),
+                    out[f][e] == If(new >= 0, new, 0)))
 
         # Calculate `v.num_flows`
-        o.add(v.num_flows[n][0] == 0)
+        cs.append(nf[0] == 0)
         for e in range(1, c.E):
-            start = Or(*[v.event_type[n][e] == 2 * f for f in range(c.F)])
-            end = Or(*[v.event_type[n][e] == 2 * f + 1 for f in range(c.F)])
-            o.add(Implies(start, v.num_flows[n][e] == v.num_flows[n][e-1] + 1))
-            o.add(Implies(end,   v.num_flows[n][e] == v.num_flows[n][e-1] - 1))
-            o.add(Implies(Not(Or(start, end)),
-                          v.num_flows[n][e] == v.num_flows[n][e-1]))
+            start = Or(*is_start[e])
+            end = Or(*is_end[e])
+            cs.append(Implies(start, nf[e] == nf[e-1] + 1))
+            cs.append(Implies(end, nf[e] == nf[e-1] - 1))
+            cs.append(Implies(Not(Or(start, end)), nf[e] == nf[e-1]))
+
+        o.add(*cs)
+
+
+def node_smt2(args: Tuple[Config, int]) -> str:
+    ''' Build the constraints for a single node and return them as SMT-LIB2.
+    Runs in a worker process: z3 terms can't be sent between processes, but
+    their text can '''
+    c, n = args
+    o = MySolver(check_declared=False)
+    v = Variables(c, o)
+    phases(c, o, v, [n])
+    tx_times(c, o, v, [n])
+    return o.to_smt2()
 
 
-def make_solver(c: Config) -> Tuple[MySolver, Variables]:
-    o = MySolver()
+def make_solver(c: Config, workers: int = 1) -> Tuple[MySolver, Variables]:
+    ''' Build the solver. With more than one worker, each node's constraints
+    are built in a separate process '''
+    # Only pay for checking variable declarations when debugging, which is
+    # also when we track unsat cores
+    o = MySolver(check_declared=c.unsat_core)
     o.set(unsat_core=c.unsat_core)
+    if c.tune_smt:
+        # The problem is linear arithmetic with If-then-else terms. Skip z3's
+        # auto-configuration and relevancy filtering, and don't propagate
+        # equalities between arithmetic and the other theories
+        o.set("smt.auto_config", False)
+        o.set("smt.relevancy", 0)
+        o.set("smt.arith.propagate_eqs", False)
     v = Variables(c, o)
     o.add(v.C_tr > 0)
     o.add(v.C_su > 0)
@@ -176,41 +237,181 @@ def make_solver(c: Config) -> Tuple[MySolver, Variables]:
     # to determine our_bytes since we can have only one event per timestep
     # o.add(v.B >= c.C)
 
-    phases(c, o, v)
-    tx_times(c, o, v)
+    if workers > 1:
+        # Variables are identified by name, so parsing a node's constraints
+        # here refers to the same variables as `v`
+        with Pool(min(workers, c.N)) as pool:
+            for smt2 in pool.imap(node_smt2, [(c, n) for n in range(c.N)]):
+                o.add(*z3.parse_smt2_string(smt2))
+    else:
+        phases(c, o, v)
+        tx_times(c, o, v)
 
     return (o, v)
 
 
+def extend(c: Config, o: MySolver, v: Variables, new_S: int):
+    ''' Grow the model from `make_solver` to `new_S` iterations in place. The
+    constraints for the existing iterations don't change, so the solver keeps
+    what it has learnt about them '''
+    assert(new_S >= c.S)
+    old_S = c.S
+    v.add_iterations(c, o, new_S - old_S)
+    c.S = new_S
+    phases(c, o, v, steps=range(old_S, new_S))
+    for n in range(c.N):
+        o.add(*our_flows(c, v, n, range(old_S, new_S)))
+
+
+def check_with(o: MySolver, cs: List[BoolRef])\
+        -> Tuple[str, Optional[ModelDict]]:
+    ''' Check the model from `make_solver` with the extra constraints `cs`.
+    These are only added inside a push/pop scope, so the solver can be reused
+    (along with whatever it learnt) for other queries. Returns the result and,
+    if satisfiable, the model '''
+    o.push()
+    o.add(*cs)
+    sat = str(o.check())
+    m = model_to_dict(o.model()) if sat == "sat" else None
+    o.pop()
+    return (sat, m)
+
+
+def check_with_params(o: MySolver, v: Variables,
+                      C_tr: Optional[float] = None,
+                      C_su: Optional[float] = None,
+                      B: Optional[float] = None)\
+        -> Tuple[str, Optional[ModelDict]]:
+    ''' Check the model from `make_solver` with some parameters fixed '''
+    cs = []
+    if C_tr is not None:
+        cs.append(v.C_tr == C_tr)
+    if C_su is not None:
+        cs.append(v.C_su == C_su)
+    if B is not None:
+        cs.append(v.B == B)
+    return check_with(o, cs)
+
+
+def check_simulated(c: Config, o: MySolver, v: Variables,
+                    C_tr: Union[float, Time], C_su: Union[float, Time],
+                    su_tx: List[List[List[Union[float, Time]]]],
+                    br_tx: List[List[List[Union[float, Time]]]])\
+        -> Tuple[str, Optional[ModelDict]]:
+    ''' Check whether the given transmit times are consistent with the fair
+    sharing model. The phases they imply are computed by `simulate_phases` and
+    handed to z3 as well, so it only has to check `tx_times` '''
+    # z3 compares the simulated phases exactly, so simulate with exactly the
+    # values it will see
+    C_tr, C_su = exact(C_tr), exact(C_su)
+    su_tx, br_tx = [[[[exact(x) for x in blocks] for blocks in node]
+                     for node in tx] for tx in [su_tx, br_tx]]
+    tr, su, br = simulate_phases(c, C_tr, C_su, su_tx, br_tx)
+    cs = [v.C_tr == C_tr, v.C_su == C_su]
+    for n in range(c.N):
+        for s in range(c.S):
+            cs.append(v.tr[n][s] == tr[n][s])
+            for i in range(c.N):
+                cs.append(v.su[n][s][i] == su[n][s][i])
+                cs.append(v.br[n][s][i] == br[n][s][i])
+                cs.append(v.su_tx[n][s][i] == su_tx[n][s][i])
+                cs.append(v.br_tx[n][s][i] == br_tx[n][s][i])
+    return check_with(o, cs)
+
+
+# Strategies raced by `check_portfolio`. Each is a sequence of tactics that
+# are applied one after the other, where the empty sequence is z3's default
+# solver. Solving the formula in one go means preprocessing like solve-eqs is
+# safe here
+PORTFOLIO: List[Tuple[str, ...]] = [
+    (),
+    ("smt",),
+    ("simplify", "propagate-values", "smt"),
+    ("simplify", "propagate-values", "ctx-simplify", "solve-eqs", "smt"),
+]
+
+
+def solve_smt2(args: Tuple[str, Tuple[str, ...]]) -> str:
+    ''' Solve an SMT-LIB2 formula with the given tactics. Runs in a worker
+    process, which is why everything is passed as strings '''
+    smt2, tactics = args
+    try:
+        if len(tactics) == 0:
+            s = z3.Solver()
+        elif len(tactics) == 1:
+            s = z3.Tactic(tactics[0]).solver()
+        else:
+            s = z3.Then(*tactics).solver()
+        s.from_string(smt2)
+        return str(s.check())
+    except z3.Z3Exception:
+        # E.g. a global parameter the tactic doesn't accept. Don't let one
+        # failing strategy take the rest of the race down with it
+        return "unknown"
+
+
+def check_portfolio(o: MySolver, workers: Optional[int] = None) -> str:
+    ''' Race the strategies in `PORTFOLIO` on the formula in `o`, each in its
+    own process. Returns the first sat/unsat answer, or unknown if none of
+    them gives one '''
+    # With unsat cores the constraints are only asserted through tracking
+    # literals, which would not be set in the exported formula
+    assert(not o.track_unsat)
+    smt2 = o.to_smt2()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    res = "unknown"
+    with Pool(min(workers, len(PORTFOLIO))) as pool:
+        for r in pool.imap_unordered(solve_smt2,
+                                     [(smt2, t) for t in PORTFOLIO]):
+            if r != "unknown":
+                res = r
+                break
+    # Leaving the `with` terminates whichever workers are still running
+    return res
+
+
 def plot_model(m: ModelDict, c: Config):
-    ax, fig = plt.subplots()
-    args = {
-        "linewidth": 8,
-        "markersize": 0,
-        "solid_capstyle": "butt"
+    fig, ax = plt.subplots()
+    # Collect segments by color, so each color is drawn as a single artist
+    segments: Dict[str, List[List[Tuple[float, float]]]] = {
+        "black": [], "red": [], "tomato": [], "blue": []
     }
+    # Pull the values we need out of the model once, as floats indexed the
+    # same way as in `Variables`
+    C_tr = float(m["C_tr"])
+    tr = [[float(m[f"tr_{n},{s}"]) for s in range(c.S)] for n in range(c.N)]
+    su, su_tx, br = [[[[float(m[f"{name}_{n},{s},{i}"]) for i in range(c.N)]
+                       for s in range(c.S)] for n in range(c.N)]
+                     for name in ["su", "su_tx", "br"]]
+
     for n in range(c.N):
         for s in range(c.S):
             # Plot training
             y = 3 * n + 0.8
-            start = m[f"tr_{n},{s}"]
-            end = start + m["C_tr"]
-            plt.plot([start, end], [y, y], **args, color="black")
+            start = tr[n][s]
+            end = start + C_tr
+            segments["black"].append([(start, y), (end, y)])
 
             for i in range(c.N-1):
                 # Plot summing
                 y = 3 * n + 1 + i / (c.N - 1)
-                start = m[f"su_{n},{s},{i}"]
-                end_1 = start + m[f"su_tx_{n},{s},{i}"]
-                end_2 = end_1 + m["C_tr"]
-                plt.plot([start, end_1], [y, y], **args, color="red")
-                plt.plot([end_1, end_2], [y, y], **args, color="tomato")
+                start = su[n][s][i]
+                end_1 = start + su_tx[n][s][i]
+                end_2 = end_1 + C_tr
+                segments["red"].append([(start, y), (end_1, y)])
+                segments["tomato"].append([(end_1, y), (end_2, y)])
 
                 # Plot broadcast
                 y = 3 * n + 2 + i / (c.N - 1)
-                start = m[f"br_{n},{s},{i}"]
-                end = start + m[f"su_tx_{n},{s},{i}"]
-                plt.plot([start, end], [y, y], **args, color="blue")
+                start = br[n][s][i]
+                end = start + su_tx[n][s][i]
+                segments["blue"].append([(start, y), (end, y)])
+    for color, segs in segments.items():
+        ax.add_collection(LineCollection(segs, linewidth=8, color=color,
+                                         capstyle="butt"))
+    # Collections don't update the data limits by themselves
+    ax.autoscale()
     plt.show()
 
 
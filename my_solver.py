@@ -1,6 +1,7 @@
 from typing import List, Set
-from z3 import ArithRef, Bool, BoolRef, Function, FuncDeclRef, Int, Real,\
-    Solver
+from z3 import ArithRef, BitVec, BitVecRef, Bool, BoolRef, Function,\
+    FuncDeclRef, Int, IntSort, Real, RealSort, Solver, SortRef, Z3_mk_const,\
+    to_symbol
 
 
 def extract_vars(e: BoolRef) -> List[str]:
@@ -8,7 +9,7 @@ def extract_vars(e: BoolRef) -> List[str]:
         if str(e)[:4] == "Var(":
             return []
         elif type(e) == ArithRef or type(e) == BoolRef\
-                or type(e) == FuncDeclRef:
+                or type(e) == BitVecRef or type(e) == FuncDeclRef:
             return [str(e)]
         else:
             return []
@@ -22,29 +23,41 @@ class MySolver:
     num_constraints: int
     variables: Set[str]
     track_unsat: bool
+    check_declared: bool
 
-    def __init__(self):
+    def __init__(self, check_declared: bool = True):
         self.s = Solver()
         self.num_constraints = 0
         self.variables = {"False", "True"}
         self.track_unsat = False
-
-    def add(self, expr):
-        for var in extract_vars(expr):
-            if var not in self.variables:
-                print(f"Warning: {var} in {str(expr)} not previously declared")
-                assert(False)
+        # Whether to check that every variable in an added constraint was
+        # declared through this solver. This walks the whole expression, so it
+        # is worth turning off when not debugging
+        self.check_declared = check_declared
+
+    def add(self, *exprs):
+        if self.check_declared:
+            for expr in exprs:
+                for var in extract_vars(expr):
+                    if var not in self.variables:
+                        print(f"Warning: {var} in {str(expr)} not previously "
+                              "declared")
+                        assert(False)
         if self.track_unsat:
-            self.s.assert_and_track(expr,
-                                    str(expr) + f"  :{self.num_constraints}")
+            # Each constraint needs its own tracking literal
+            for expr in exprs:
+                self.s.assert_and_track(
+                    expr, str(expr) + f"  :{self.num_constraints}")
+                self.num_constraints += 1
         else:
-            self.s.add(expr)
-        self.num_constraints += 1
+            # Hand everything to z3 in a single call
+            self.s.add(*exprs)
+            self.num_constraints += len(exprs)
 
-    def set(self, **kwds):
+    def set(self, *args, **kwds):
         if "unsat_core" in kwds and kwds["unsat_core"]:
             self.track_unsat = True
-        return self.s.set(**kwds)
+        return self.s.set(*args, **kwds)
 
     def check(self):
         return self.s.check()
@@ -52,6 +65,12 @@ class MySolver:
     def model(self):
         return self.s.model()
 
+    def push(self):
+        self.s.push()
+
+    def pop(self, num: int = 1):
+        self.s.pop(num)
+
     def unsat_core(self):
         assert(self.track_unsat)
         return self.s.unsat_core()
@@ -59,6 +78,9 @@ class MySolver:
     def to_smt2(self):
         return self.s.to_smt2()
 
+    def statistics(self):
+        return self.s.statistics()
+
     def assertions(self):
         return self.s.assertions()
 
@@ -66,6 +88,23 @@ class MySolver:
         self.variables.add(name)
         return Real(name)
 
+    def Reals(self, names: List[str]) -> List[ArithRef]:
+        ''' Declare many Real variables at once '''
+        return self.consts(names, RealSort())
+
+    def Ints(self, names: List[str]) -> List[ArithRef]:
+        ''' Declare many Int variables at once '''
+        return self.consts(names, IntSort())
+
+    def consts(self, names: List[str], sort: SortRef) -> List[ArithRef]:
+        # Make the constants directly with the low-level API, so the sort is
+        # only constructed once rather than for each variable
+        self.variables.update(names)
+        ctx = sort.ctx
+        return [ArithRef(Z3_mk_const(ctx.ref(), to_symbol(name, ctx),
+                                     sort.ast), ctx)
+                for name in names]
+
     def Function(self, name: str, t1, t2):
         self.variables.add(name)
         return Function(name, t1, t2)
@@ -74,6 +113,10 @@ class MySolver:
         self.variables.add(name)
         return Int(name)
 
+    def BitVec(self, name: str, bits: int):
+        self.variables.add(name)
+        return BitVec(name, bits)
+
     def Bool(self, name: str):
         self.variables.add(name)
         return Bool(name)
@@ -0,0 +1,58 @@
+from config import Config
+
+from fractions import Fraction
+from typing import List, Tuple, Union
+
+'''A direct simulation of the recurrence that `main.phases` encodes. Given the
+compute times and every transmit time, when each phase happens is fully
+determined, so there is no need to involve z3 to work it out. This is useful
+for sweeping parameters quickly and as a ground truth for the z3 model'''
+
+# Times are exact. With floats, the sums below get rounded and no longer match
+# what z3 makes of the same inputs
+Time = Union[int, Fraction]
+Times2 = List[List[Time]]
+Times3 = List[List[List[Time]]]
+
+
+def exact(x: Union[float, Time]) -> Fraction:
+    ''' The value z3 gives `x`. z3 reads a float by its decimal repr, so 0.1
+    is 1/10 rather than the binary fraction the float actually holds '''
+    return Fraction(repr(x)) if isinstance(x, float) else Fraction(x)
+
+
+def simulate_phases(c: Config, C_tr: Time, C_su: Time, su_tx: Times3,
+                    br_tx: Times3) -> Tuple[Times2, Times3, Times3]:
+    ''' Returns (tr, su, br), indexed the same way as in `Variables`. Use
+    `exact` to convert floats first '''
+    N, S = c.N, c.S
+    tr = [[0] * S for _ in range(N)]
+    su = [[[0] * N for _ in range(S)] for _ in range(N)]
+    br = [[[0] * N for _ in range(S)] for _ in range(N)]
+    pre_of = [(n - 1) % N for n in range(N)]
+
+    for s in range(S):
+        for n in range(N):
+            if s > 0:
+                tr[n][s] = br[pre_of[n]][s-1][-1]
+            su[n][s][0] = tr[n][s] + C_tr
+
+        # Block i of a node depends on block i-1 of its predecessor, so go
+        # around the whole ring before moving to the next block
+        for i in range(1, N):
+            for n in range(N):
+                pre = pre_of[n]
+                ready = su[pre][s][i-1] + su_tx[pre][s][i-1] + C_su
+                clear = su[n][s][i-1] + su_tx[n][s][i-1]
+                su[n][s][i] = max(ready, clear)
+
+        for n in range(N):
+            br[n][s][0] = su[n][s][-1]
+        for i in range(1, N):
+            for n in range(N):
+                pre = pre_of[n]
+                ready = br[pre][s][i-1] + br_tx[pre][s][i-1]
+                clear = br[n][s][i-1] + br_tx[n][s][i-1]
+                br[n][s][i] = max(ready, clear)
+
+    return (tr, su, br)
@@ -1,88 +1,333 @@
-from continuous_model import GlobalVars, Config, make_solver
+import config
+from continuous_model import GlobalVars, Config, SWEEP_CONFIGS, \
+    config_from_dict, make_solver, presimplify, symmetric_rings
+from fractions import Fraction
+import hashlib
+import main
+import my_solver
+import os
 from pyz3_utils import MySolver, run_query
+import shelve
+from simulate import Times3, simulate_phases
+from typing import List, Optional
 import unittest
-from z3 import And, Or
+import variables
+from z3 import And, BoolRef, Implies, Not, Or, Solver, get_full_version, \
+    parse_smt2_string
 
-class TestContinuousModel(unittest.TestCase):
-    def test_exists(self):
-        '''If we don't add any fancy constraints, there better exist a
-        solution!'''
-        c = Config()
-        s = MySolver()
-        v = make_solver(c, s)
-        res = run_query(c, s, v, timeout=60)
-        self.assertEqual(res.satisfiable, "sat")
 
+class ResultCache:
+    ''' sat/unsat results stored on disk across runs. A query is identified
+    by the z3 version, the text of the formula and the assumptions it is
+    checked under, so any change to the model gives new keys '''
+    path: str
 
-    def test_monotone(self):
-        c = Config()
-        s = MySolver()
-        v = make_solver(c, s)
-
-        # Can any of the variables be decreasing?
-        cond = []
-        for t in range(1, c.num_timesteps):
-            for r in range(c.num_rings):
-                for n in range(c.num_nodes_per_ring):
-                    nt1 = v.times[t-1].rings[r].nodes[n]
-                    nt2 = v.times[t].rings[r].nodes[n]
-                    eq = nt1.round == nt2.round
-                    cond.append(nt1.round > nt2.round)
-                    cond.append(And(nt1.backprop > nt2.backprop, eq))
-                    cond.append(And(nt1.sum_sent > nt2.sum_sent, eq))
-                    cond.append(And(nt1.broad_sent > nt2.broad_sent, eq))
-                    cond.append(And(nt2.ready_to_send < 0, eq))
-                    cond.append(And(nt2.tot_data_sent < 0, eq))
-        s.add(Or(*cond))
-        res = run_query(c, s, v, timeout=60)
-        if res.satisfiable == "sat":
-            from continuous_model import plot
-            plot(res.c, res.v)
-        self.assertEqual(res.satisfiable, "unsat")
+    def __init__(self, path: str):
+        self.path = path
+
+    def keys(self, s: MySolver, assumptions: List[BoolRef]) -> List[str]:
+        base = hashlib.sha256(get_full_version().encode())
+        base.update(s.s.to_smt2().encode())
+        keys = []
+        for a in assumptions:
+            h = base.copy()
+            h.update(a.sexpr().encode())
+            keys.append(h.hexdigest())
+        return keys
+
+    def get(self, key: str) -> Optional[str]:
+        with shelve.open(self.path) as db:
+            return db.get(key)
+
+    def put(self, key: str, res: str):
+        # Don't remember timeouts and the like
+        if res in ["sat", "unsat"]:
+            with shelve.open(self.path) as db:
+                db[key] = res
 
-    def test_operation_order(self):
-        c = Config()
-        s = MySolver()
-        v = make_solver(c, s)
 
-        cond = []
-        for t in range(1, c.num_timesteps):
-            for r in range(c.num_rings):
-                for n in range(c.num_nodes_per_ring):
-                    nt1 = v.times[t-1].rings[r].nodes[n]
-                    nt2 = v.times[t].rings[r].nodes[n]
+def monotone_violations(c: Config, v: GlobalVars) -> BoolRef:
+    '''Can any of the variables be decreasing?'''
+    # Group the violations by ring, with one disjunct per node and timestep
+    ring_cond = [[] for r in range(c.num_rings)]
+    for t in range(1, c.num_timesteps):
+        for r in range(c.num_rings):
+            before = v.times[t-1].rings[r].nodes
+            after = v.times[t].rings[r].nodes
+            for n in range(c.num_nodes_per_ring):
+                nt1, nt2 = before[n], after[n]
+                eq = nt1.round == nt2.round
+                ring_cond[r].append(Or(
+                    nt1.round > nt2.round,
+                    And(Or(nt1.backprop > nt2.backprop,
+                           nt1.sum_sent > nt2.sum_sent,
+                           nt1.broad_sent > nt2.broad_sent,
+                           nt2.ready_to_send < 0,
+                           nt2.tot_data_sent < 0),
+                        eq)))
+    return Or(*[Or(*rc) for rc in ring_cond])
 
+
+def operation_order_violations(c: Config, v: GlobalVars) -> BoolRef:
+    '''Can any node do things out of order?'''
+    # Amount of data each node is responsible for in each ring
+    chunk = [v.tot_size[r] / c.num_nodes_per_ring
+             for r in range(c.num_rings)]
+
+    # Group the violations by ring, with one disjunct per node and timestep
+    ring_cond = [[] for r in range(c.num_rings)]
+    for t in range(1, c.num_timesteps):
+        for r in range(c.num_rings):
+            before = v.times[t-1].rings[r].nodes
+            after = v.times[t].rings[r].nodes
+            for n in range(c.num_nodes_per_ring):
+                nt1, nt2 = before[n], after[n]
+                prev = before[n-1]
+
+                ring_cond[r].append(Or(
                     # Broadcast can only start if summing is over
-                    cond.append(
-                        And(nt2.broad_sent > nt1.broad_sent,
-                            nt1.sum_sent != v.tot_size[r]))
+                    And(nt2.broad_sent > nt1.broad_sent,
+                        nt1.sum_sent != v.tot_size[r]),
 
                     # We cannot send more data than we have
-                    cond.append(nt2.tot_data_sent > nt2.ready_to_send)
+                    nt2.tot_data_sent > nt2.ready_to_send,
 
                     # We ought not be sending more sum data than we have
-                    cond.append(And(
-                        nt2.sum_sent > v.times[t-1].rings[r].nodes[n-1].sum_sent
-                        + v.tot_size[r] / c.num_nodes_per_ring,
-                        nt2.round >= v.times[t-1].rings[r].nodes[n-1].round))
-                    cond.append(And(
-                        nt2.broad_sent
-                        > v.times[t-1].rings[r].nodes[n-1].broad_sent
-                        + v.tot_size[r] / c.num_nodes_per_ring,
-                        nt2.round >= v.times[t-1].rings[r].nodes[n-1].round))
-
-        s.add(Or(*cond))
-
-        # Just so the example has nice values
-        # for r in range(c.num_rings):
-        #     s.add(v.tot_size[r] <= 5)
-        #     s.add(v.tot_backprop[r] <= 5)
+                    And(Or(nt2.sum_sent > prev.sum_sent + chunk[r],
+                           nt2.broad_sent > prev.broad_sent + chunk[r]),
+                        nt2.round >= prev.round)))
+    return Or(*[Or(*rc) for rc in ring_cond])
+
+
+class TestContinuousModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        '''All tests query the same model, so build it once. Each test then
+        checks it with its own query turned on'''
+        cls.c = Config()
+        # Otherwise test_monotone would be assuming what it wants to check
+        cls.c.monotone_hints = False
+        cls.s = MySolver()
+        cls.v = make_solver(cls.c, cls.s)
+        c, s, v = cls.c, cls.s, cls.v
+
+        # Each query is turned on by assuming its literal. They only differ in
+        # that literal, so checking them in the same solver lets each reuse
+        # what the previous ones learnt. This is faster than solving them
+        # separately, even in parallel
+        cls.queries = {
+            "exists": s.Bool("test_exists"),
+            "monotone": s.Bool("test_monotone"),
+            "operation_order": s.Bool("test_operation_order"),
+        }
+        s.add(Implies(cls.queries["monotone"], monotone_violations(c, v)))
+        s.add(Implies(cls.queries["operation_order"],
+                      operation_order_violations(c, v)))
+
+        # Let z3's cheap rewrites shrink the base formula before the real work
+        presimplify(s)
+
+        # If the Z3_RESULT_CACHE environment variable names a file, answers
+        # found by previous runs are looked up there instead of solving again.
+        # The keys are computed before any check, since checking changes how
+        # z3 prints the formula
+        path = os.environ.get("Z3_RESULT_CACHE")
+        cls.cache = None if path is None else ResultCache(path)
+        if cls.cache is not None:
+            names = list(cls.queries)
+            cls.keys = dict(zip(names, cls.cache.keys(
+                s, [cls.queries[q] for q in names])))
+
+    def check(self, query: str) -> str:
+        '''Check the shared model with `query` turned on'''
+        if self.cache is not None:
+            res = self.cache.get(self.keys[query])
+            if res is not None:
+                return res
+
+        self.s.s.set("timeout", 60 * 1000)
+        res = str(self.s.s.check(self.queries[query]))
+        if self.cache is not None:
+            self.cache.put(self.keys[query], res)
+        return res
+
+    def setUp(self):
+        # Tests share the solver, so whatever a test adds must be undone
+        # before the next one. Checks themselves happen outside any scope, so
+        # that what the solver learns carries over to the next test
+        self.num_assertions = len(self.s.assertions())
+
+    def tearDown(self):
+        self.assertEqual(len(self.s.assertions()), self.num_assertions)
+
+    def plot_counterexample(self, query: str):
+        '''Re-solve the query in the main solver to get and plot its model.
+        Prefer a model with small values, since it is easier to read'''
+        c, s, v = self.c, self.s, self.v
+        s.push()
+        s.add(self.queries[query])
 
+        # Just so the example has nice values. These are only a preference,
+        # so drop them if no counterexample satisfies them
+        s.push()
+        for r in range(c.num_rings):
+            s.add(v.tot_size[r] <= 5)
+            s.add(v.tot_backprop[r] <= 5)
         res = run_query(c, s, v, timeout=60)
+        s.pop()
+        if res.satisfiable != "sat":
+            res = run_query(c, s, v, timeout=60)
+        s.pop()
+
         if res.satisfiable == "sat":
             from continuous_model import plot
             plot(res.c, res.v)
-        self.assertEqual(res.satisfiable, "unsat")
+
+    def test_exists(self):
+        '''If we don't add any fancy constraints, there better exist a
+        solution!'''
+        self.assertEqual(self.check("exists"), "sat")
+
+
+    def test_monotone(self):
+        res = self.check("monotone")
+        if res == "sat":
+            self.plot_counterexample("monotone")
+        self.assertEqual(res, "unsat")
+
+    def test_operation_order(self):
+        res = self.check("operation_order")
+        if res == "sat":
+            self.plot_counterexample("operation_order")
+        self.assertEqual(res, "unsat")
+
+
+class TestRingSymmetry(unittest.TestCase):
+    def test_sweep_configs(self):
+        '''Merging rings that aren't interchangeable would hide
+        counterexamples, so check the classes for every config we verify'''
+        expected = [
+            [[0, 1]],
+            [[0, 1]],
+            [[0, 1]],
+            [[0], [1], [2]],
+            # Rings 0 and 2 both neighbor ring 1, but at different nodes of it,
+            # so they can't be swapped
+            [[0], [1], [2]],
+            [[0], [1], [2], [3]],
+        ]
+        self.assertEqual(len(SWEEP_CONFIGS), len(expected))
+        for (conf, classes) in zip(SWEEP_CONFIGS, expected):
+            self.assertEqual(symmetric_rings(config_from_dict(conf)), classes)
+
+    def test_merge_outer_rings(self):
+        '''Rings 0 and 2 are interchangeable if both share ring 1's node 1'''
+        c = config_from_dict(SWEEP_CONFIGS[4])
+        c.neighbors = [((0, 1), (1, 1)), ((1, 1), (2, 1))]
+        self.assertEqual(symmetric_rings(c), [[0, 2], [1]])
+
+
+def varied_tx(c: config.Config, seed: int) -> Times3:
+    '''Arbitrary but varied transmit times for the model in main.py'''
+    return [[[Fraction(1 + (7 * n + 3 * s + 5 * i + seed) % 5, 4)
+              for i in range(c.N)] for s in range(c.S)] for n in range(c.N)]
+
+
+class TestMainModel(unittest.TestCase):
+    def small_config(self) -> config.Config:
+        '''Small enough that the checks below take well under a second'''
+        c = config.Config()
+        c.N, c.S, c.E = 2, 2, 8
+        return c
+
+    def phases_only(self, c: config.Config):
+        o = my_solver.MySolver()
+        v = variables.Variables(c, o)
+        main.phases(c, o, v)
+        return (o, v)
+
+    def phases_and_flows(self, c: config.Config):
+        o, v = self.phases_only(c)
+        for n in range(c.N):
+            o.add(*main.our_flows(c, v, n, range(c.S)))
+        return (o, v)
+
+    def assertEquivalent(self, a: List[BoolRef], b: List[BoolRef]):
+        '''Both sets of constraints allow exactly the same solutions'''
+        for (x, y) in [(a, b), (b, a)]:
+            s = Solver()
+            s.add(*x)
+            s.add(Not(And(*y)))
+            self.assertEqual(str(s.check()), "unsat")
+
+    def test_simulate_phases(self):
+        '''Given the same inputs, the `phases` constraints force exactly the
+        times that `simulate_phases` computes'''
+        c = config.Config()
+        o, v = self.phases_only(c)
+        C_tr, C_su = Fraction(3, 2), Fraction(1, 3)
+        su_tx, br_tx = varied_tx(c, 0), varied_tx(c, 1)
+        tr, su, br = simulate_phases(c, C_tr, C_su, su_tx, br_tx)
+
+        o.add(v.C_tr == C_tr, v.C_su == C_su)
+        same = []
+        for n in range(c.N):
+            for s in range(c.S):
+                same.append(v.tr[n][s] == tr[n][s])
+                for i in range(c.N):
+                    o.add(v.su_tx[n][s][i] == su_tx[n][s][i],
+                          v.br_tx[n][s][i] == br_tx[n][s][i])
+                    same.append(v.su[n][s][i] == su[n][s][i])
+                    same.append(v.br[n][s][i] == br[n][s][i])
+        self.assertEqual(main.check_with(o, [And(*same)])[0], "sat")
+        self.assertEqual(main.check_with(o, [Not(And(*same))])[0], "unsat")
+
+    def test_check_simulated_floats(self):
+        '''Floats are taken to mean what z3 would make of them, not rounded
+        along the way'''
+        c = config.Config()
+        o, v = self.phases_only(c)
+        tx = [[[0.3] * c.N for s in range(c.S)] for n in range(c.N)]
+        self.assertEqual(main.check_simulated(c, o, v, 0.1, 0.2, tx, tx)[0],
+                         "sat")
+
+    def test_extend(self):
+        '''Growing a model with `extend` gives the same constraints as building
+        it at the larger size to begin with'''
+        c = self.small_config()
+        c.S -= 1
+        o, v = self.phases_and_flows(c)
+        main.extend(c, o, v, c.S + 1)
+        o_full, v_full = self.phases_and_flows(self.small_config())
+        # Otherwise equivalence would be trivial
+        self.assertEqual(str(o.check()), "sat")
+        self.assertEquivalent(list(o.assertions()), list(o_full.assertions()))
+
+        # Extending to the current size does nothing
+        num_assertions = len(o.assertions())
+        main.extend(c, o, v, c.S)
+        self.assertEqual(len(o.assertions()), num_assertions)
+        self.assertEqual(len(v.tr[0]), c.S)
+
+    def test_node_smt2(self):
+        '''The constraints a worker process builds for a node are the same as
+        those built for it serially'''
+        c = self.small_config()
+        for n in range(c.N):
+            o = my_solver.MySolver()
+            v = variables.Variables(c, o)
+            main.phases(c, o, v, [n])
+            main.tx_times(c, o, v, [n])
+            self.assertEqual(str(o.check()), "sat")
+            self.assertEquivalent(list(o.assertions()),
+                                  list(parse_smt2_string(
+                                      main.node_smt2((c, n)))))
+
+    def test_portfolio(self):
+        '''Racing strategies gives the same answer as the plain solver, even
+        with continuous_model (and whatever z3 settings it makes) loaded'''
+        o, v = main.make_solver(config.Config())
+        self.assertEqual(main.check_portfolio(o, workers=4), str(o.check()))
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,5 @@
 from fractions import Fraction
-from typing import Dict, Union
+from typing import Callable, Dict, Union
 import z3
 
 ModelDict = Dict[str, Union[Fraction, bool]]
@@ -8,15 +8,34 @@ ModelDict = Dict[str, Union[Fraction, bool]]
 def model_to_dict(model: z3.ModelRef) -> ModelDict:
     ''' Utility function that takes a z3 model and extracts its variables to a
     dict'''
-    decls = model.decls()
-    res: Dict[str, Union[Fraction, bool]] = {}
-    for d in decls:
-        val = model[d]
-        if type(val) == z3.BoolRef:
-            res[d.name()] = bool(val)
-        elif type(val) == z3.IntNumRef:
-            res[d.name()] = Fraction(val.as_long(), 1)
-        else:
-            # Assume it is numeric
-            res[d.name()] = val.as_fraction()
+    # Go through the low-level API so we don't construct a python wrapper for
+    # every declaration and value
+    ctx, m = model.ctx.ref(), model.model
+
+    def as_bool(val) -> bool:
+        return z3.Z3_get_bool_value(ctx, val) == z3.Z3_L_TRUE
+
+    def as_num(val) -> Fraction:
+        if z3.Z3_is_numeral_ast(ctx, val):
+            # The numeral string is exact, either "p" or "p/q"
+            return Fraction(z3.Z3_get_numeral_string(ctx, val))
+        # An irrational algebraic number. Approximate it to 100 decimal places
+        # (z3 marks the truncation with a '?')
+        return Fraction(z3.Z3_get_numeral_decimal_string(
+            ctx, val, 100).rstrip("?"))
+
+    # How to convert a value, based on the kind of its sort
+    convert: Dict[int, Callable] = {
+        z3.Z3_BOOL_SORT: as_bool,
+        z3.Z3_INT_SORT: as_num,
+        z3.Z3_REAL_SORT: as_num,
+        z3.Z3_BV_SORT: as_num,
+    }
+
+    res: ModelDict = {}
+    for i in range(z3.Z3_model_get_num_consts(ctx, m)):
+        d = z3.Z3_model_get_const_decl(ctx, m, i)
+        name = z3.Z3_get_symbol_string(ctx, z3.Z3_get_decl_name(ctx, d))
+        kind = z3.Z3_get_sort_kind(ctx, z3.Z3_get_range(ctx, d))
+        res[name] = convert[kind](z3.Z3_model_get_const_interp(ctx, m, d))
     return res
@@ -1,6 +1,23 @@
 from config import Config
 from my_solver import MySolver
 
+from itertools import product
+from math import prod
+from typing import Any, Sequence, Tuple
+
+
+def reshape(flat: Sequence[Any], *shape: int) -> Tuple[Any, ...]:
+    ''' Nest a flat, row-major list into tuples of the given shape. The
+    variables never change once declared, so tuples suffice and don't carry
+    a list's spare capacity '''
+    if len(shape) == 1:
+        return tuple(flat)
+    # Size of each sub-list. Taken from the inner dimensions so that empty
+    # dimensions (e.g. adding 0 iterations) work too
+    step = prod(shape[1:])
+    return tuple(reshape(flat[i * step:(i + 1) * step], *shape[1:])
+                 for i in range(shape[0]))
+
 
 class Variables:
     def __init__(self, c: Config, o: MySolver):
@@ -8,39 +25,78 @@ class Variables:
         self.C_su = o.Real("C_su")
         self.B = o.Real("B")
 
+        # Variables for each iteration, indexed [n][s][...]. They are filled
+        # in by `add_iterations`, which describes what each of them is
+        self.tr = [[] for n in range(c.N)]
+        self.su = [[] for n in range(c.N)]
+        self.br = [[] for n in range(c.N)]
+        self.su_tx = [[] for n in range(c.N)]
+        self.br_tx = [[] for n in range(c.N)]
+        self.su_end = [[] for n in range(c.N)]
+        self.br_end = [[] for n in range(c.N)]
+        self.add_iterations(c, o, c.S)
+
+        # Each of these is declared in one go and then nested
+        ne = list(product(range(c.N), range(c.E)))
+        # A sorted list of events that happen on each link
+        self.events = reshape(o.Reals([f"events_{n},{e}" for (n, e) in ne]),
+                              c.N, c.E)
+        # The type of event. For flow i, event type 2*i denotes the start of
+        # that flow while 2*i+1 denotes the end. It only ever takes a handful
+        # of values, so a small bitvector is enough if we want one
+        if c.bv_event_type:
+            bits = (2 * c.F + 1).bit_length()
+            self.event_type = reshape(
+                [o.BitVec(f"event_type_{n},{e}", bits) for (n, e) in ne],
+                c.N, c.E)
+        else:
+            self.event_type = reshape(
+                o.Ints([f"event_type_{n},{e}" for (n, e) in ne]), c.N, c.E)
+        # Number of flows active between events[e] and events[e+1]
+        self.num_flows = reshape(
+            o.Ints([f"num_flows_{n},{e}" for (n, e) in ne]), c.N, c.E)
+        # For each flow on each link, the number of outstanding bytes when the
+        # t^th `event` happened. The 0^th flow is us
+        self.outstanding = reshape(
+            o.Reals([f"outstanding_{n},{f},{e}" for (n, f, e) in
+                     product(range(c.N), range(c.F), range(c.E))]),
+            c.N, c.F, c.E)
+
+    def add_iterations(self, c: Config, o: MySolver, num: int):
+        ''' Add the variables for `num` more iterations '''
+        new = range(len(self.tr[0]), len(self.tr[0]) + num)
+        nsi = list(product(range(c.N), new, range(c.N)))
+
         # The time at which the s^th iteration's training starts
-        self.tr = [[o.Real(f"tr_{n},{s}") for s in range(c.S)] for n in
-                   range(c.N)]
+        tr = reshape(o.Reals([f"tr_{n},{s}" for (n, s) in
+                              product(range(c.N), new)]), c.N, num)
         # The time at which we start trasmitting the i^th block when summing in
         # the s^th iteration. Note, the last sum event is virtual: it doesn't
         # really happen, it merely indicates when the first broadcast started
-        self.su = [[[o.Real(f"su_{n},{s},{i}") for i in range(c.N)] for s in
-                    range(c.S)] for n in range(c.N)]
+        su = reshape(o.Reals([f"su_{n},{s},{i}" for (n, s, i) in nsi]),
+                     c.N, num, c.N)
         # The time at which we start trasmitting the n^th block when
         # broadcasting in the s^th iteration. Similar to su, the last event is
         # virtual
-        self.br = [[[o.Real(f"br_{n},{s},{i}") for i in range(c.N)] for s in
-                    range(c.S)] for n in range(c.N)]
-
+        br = reshape(o.Reals([f"br_{n},{s},{i}" for (n, s, i) in nsi]),
+                     c.N, num, c.N)
         # Transmit time for transmitting during summing
-        self.su_tx = [[[o.Real(f"su_tx_{n},{s},{i}") for i in range(c.N)] for s
-                       in range(c.S)] for n in range(c.N)]
+        su_tx = reshape(o.Reals([f"su_tx_{n},{s},{i}" for (n, s, i) in nsi]),
+                        c.N, num, c.N)
         # Transmit time for transmitting during broadcast
-        self.br_tx = [[[o.Real(f"br_tx_{n},{s},{i}") for i in range(c.N)] for s
-                       in range(c.S)] for n in range(c.N)]
+        br_tx = reshape(o.Reals([f"br_tx_{n},{s},{i}" for (n, s, i) in nsi]),
+                        c.N, num, c.N)
 
-        # A sorted list of events that happen on each link
-        self.events = [[o.Real(f"events_{n},{e}") for e in range(c.E)]
-                       for n in range(c.N)]
-        # The type of event. For flow i, event type 2*i denotes the start of
-        # that flow while 2*i+1 denotes the end
-        self.event_type = [[o.Int(f"event_type_{n},{e}") for e in range(c.E)]
-                           for n in range(c.N)]
-        # Number of flows active between events[e] and events[e+1]
-        self.num_flows = [[o.Real(f"num_flows_{n},{e}") for e in range(c.E)]
-                          for n in range(c.N)]
-        # For each flow on each link, the number of outstanding bytes when the
-        # t^th `event` happened. The 0^th flow is us
-        self.outstanding = [[[o.Real(f"outstanding_{n},{f},{e}") for e in
-                              range(c.E)] for f in range(c.F)] for n in
-                            range(c.N)]
+        for n in range(c.N):
+            self.tr[n].extend(tr[n])
+            self.su[n].extend(su[n])
+            self.br[n].extend(br[n])
+            self.su_tx[n].extend(su_tx[n])
+            self.br_tx[n].extend(br_tx[n])
+            # The time at which each of those transmissions ends. These are
+            # terms rather than variables, built once so every constraint
+            # shares them
+            self.su_end[n].extend([[su[n][s][i] + su_tx[n][s][i]
+                                    for i in range(c.N)] for s in range(num)])
+            self.br_end[n].extend([[br[n][s][i] + br_tx[n][s][i]
+                                    for i in range(c.N)] for s in range(num)])